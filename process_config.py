@@ -8,10 +8,15 @@ import re
 import subprocess
 import sys
 import tempfile
+import urllib.parse
 
-from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cache, lru_cache
 from typing import Any, Dict, Literal, Optional, Tuple, Union
 
+import requests
+
 
 HashAlgorithm = Literal["blake3", "sha256"]
 ArtifactFormat = Literal["gz", "tar", "tar.gz", "tar.zst", "zst"]
@@ -21,10 +26,49 @@ OUTPUTS_PARAM = "outputs"
 EXCLUDE_HTTP_PROVIDER_PARAM = "exclude-http-provider"
 EXCLUDE_GITHUB_PROVIDER_PARAM = "exclude-github-release-provider"
 
+# Size of the chunks read from the network when downloading release assets.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# (connect, read) timeouts in seconds for requests to GitHub. The read timeout
+# bounds the wait for each chunk of a response, not the whole download.
+REQUEST_TIMEOUT = (10, 60)
+
+# Maximum number of release assets that are downloaded and hashed at once.
+MAX_CONCURRENT_DOWNLOADS = 8
+
+
+@dataclass(frozen=True)
+class EnvConfig:
+    """Variables set by the GitHub Actions runner. The environment does not
+    change over the lifetime of the process, so it is read once at import time.
+    """
+
+    repo: Optional[str]
+    sha: Optional[str]
+    server_url: Optional[str]
+    api_url: Optional[str]
+    workspace: Optional[str]
+    # Tokens are kept out of the repr so that they cannot leak into logs.
+    token: Optional[str] = field(repr=False)
+    enterprise_token: Optional[str] = field(repr=False)
+
+    @staticmethod
+    def from_environ() -> "EnvConfig":
+        env = os.environ
+        return EnvConfig(
+            repo=env.get("GITHUB_REPOSITORY"),
+            sha=env.get("GITHUB_SHA"),
+            server_url=env.get("GITHUB_SERVER_URL"),
+            api_url=env.get("GITHUB_API_URL"),
+            workspace=env.get("GITHUB_WORKSPACE"),
+            token=env.get("GH_TOKEN") or env.get("GITHUB_TOKEN"),
+            enterprise_token=(
+                env.get("GH_ENTERPRISE_TOKEN") or env.get("GITHUB_ENTERPRISE_TOKEN")
+            ),
+        )
 
-def main() -> None:
-    exit_code = _main()
-    sys.exit(exit_code)
+
+ENV = EnvConfig.from_environ()
 
 
 def _main() -> int:
@@ -44,24 +88,39 @@ def _main() -> int:
     output_folder = args.output
     if not output_folder:
         output_folder = tempfile.mkdtemp(prefix=f"{repo.replace('/', '_')}_dotslash")
-    logging.info(f"DotSlash files will be written to `{output_folder}")
+    logging.info("DotSlash files will be written to `%s`", output_folder)
 
     tag = args.tag
     github_server_url = args.server
     api_server_url = args.api_server
     gh_repo_arg = f"{github_server_url}/{repo}"
+    hostname = urllib.parse.urlparse(github_server_url).hostname
 
-    if args.local_config:
-        print(args.config)
-        with open(args.config, "r") as f:
-            config = json.load(f)
-    else:
-        config = get_config(
-            path_to_config=args.config,
-            config_ref=args.config_ref,
+    # Create the shared session up front so that the concurrent requests below
+    # do not race to create it.
+    _session(hostname)
+
+    # Fetch the release metadata while the config is being loaded.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        release_assets_future = executor.submit(
+            get_release_assets,
+            tag=tag,
             github_repository=repo,
             api_url=api_server_url,
+            hostname=hostname,
         )
+        if args.local_config:
+            print(args.config)
+            with open(args.config, "rb") as f:
+                config = json.load(f)
+        else:
+            config = get_config(
+                path_to_config=args.config,
+                config_ref=args.config_ref,
+                github_repository=repo,
+                api_url=api_server_url,
+                hostname=hostname,
+            )
     if not isinstance(config, dict):
         logging.error(f"config should be a dict, but was:")
         logging.error(json.dumps(config, indent=2))
@@ -86,11 +145,15 @@ def _main() -> int:
         )
         return 1
 
-    logging.info("using config:")
-    logging.info(json.dumps(config, indent=2))
+    # Pretty-printing these structures is not free, so only do it when the
+    # output will actually be logged.
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    if log_info:
+        logging.info("using config:\n%s", json.dumps(config, indent=2))
 
-    name_to_asset = get_release_assets(tag=tag, github_repository=repo)
-    logging.info(json.dumps(name_to_asset, indent=2))
+    name_to_asset = release_assets_future.result()
+    if log_info:
+        logging.info(json.dumps(name_to_asset, indent=2))
 
     for output_filename, output_config in outputs.items():
         platform_entries = map_platforms(output_config, name_to_asset)
@@ -98,11 +161,13 @@ def _main() -> int:
             logging.error(f"failed with error type {platform_entries}")
             return 1
 
-        logging.info(json.dumps(platform_entries, indent=2))
+        if log_info:
+            logging.info(json.dumps(platform_entries, indent=2))
 
         manifest_file_contents = generate_manifest_file(
             output_filename,
             gh_repo_arg,
+            hostname,
             tag,
             platform_entries,
             include_http_provider=not exclude_http_provider,
@@ -113,7 +178,7 @@ def _main() -> int:
         output_file = os.path.join(output_folder, output_filename)
         with open(output_file, "w") as f:
             f.write(manifest_file_contents)
-        logging.info(f"wrote manifest to {output_file}")
+        logging.info("wrote manifest to %s", output_file)
 
         if args.upload:
             # Upload manifest to release, but do not clobber. Note that this may
@@ -136,79 +201,98 @@ def _main() -> int:
 def generate_manifest_file(
     name: str,
     gh_repo_arg: str,
+    hostname: str,
     tag: str,
     platform_entries,
     include_http_provider: bool,
     include_github_release_provider: bool,
 ) -> str:
     platforms = {}
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for platform_name, platform_entry in platform_entries.items():
-            asset, platform_config = platform_entry
-            hash_algo = platform_config.get("hash", "blake3")
-            size = asset.get("size")
-            if size is None:
-                logging.error(f"missing 'size' field in asset: {asset}")
-                return 1
-
-            asset_name = asset.get("name")
-            if asset_name is None:
-                logging.error(f"missing 'name' field in asset: {asset}")
-                return 1
+    hash_args = {}
+    for platform_name, platform_entry in platform_entries.items():
+        asset, platform_config = platform_entry
+        hash_algo = platform_config.get("hash", "blake3")
+        size = asset.get("size")
+        if size is None:
+            logging.error(f"missing 'size' field in asset: {asset}")
+            return 1
 
-            path = platform_config.get("path")
-            if not path:
-                logging.error(f"missing `path` field in asset: {asset}")
-                return 1
+        asset_name = asset.get("name")
+        if asset_name is None:
+            logging.error(f"missing 'name' field in asset: {asset}")
+            return 1
 
-            if "format" in platform_config:
-                # If the user is knowingly not using any sort of compression,
-                # then `"format": null` must be explicitly specified in the JSON.
-                asset_format = platform_config["format"]
-            else:
-                asset_format = guess_artifact_format_from_asset_name(asset_name)
-                if not asset_format:
-                    logging.error(
-                        f'"format" could not be inferred from asset name: {asset_name} in {asset}, must specify explicitly'
-                    )
-                    return 1
-
-            hash_hex = compute_hash(
-                gh_repo_arg, temp_dir, tag, asset_name, hash_algo, size
-            )
+        path = platform_config.get("path")
+        if not path:
+            logging.error(f"missing `path` field in asset: {asset}")
+            return 1
 
-            providers = []
-            if include_http_provider:
-                providers.append(
-                    {
-                        "url": asset["url"],
-                    }
-                )
-            if include_github_release_provider:
-                providers.append(
-                    {
-                        "type": "github-release",
-                        "repo": gh_repo_arg,
-                        "tag": tag,
-                        "name": asset_name,
-                    }
+        if "format" in platform_config:
+            # If the user is knowingly not using any sort of compression,
+            # then `"format": null` must be explicitly specified in the JSON.
+            asset_format = platform_config["format"]
+        else:
+            asset_format = guess_artifact_format_from_asset_name(asset_name)
+            if not asset_format:
+                logging.error(
+                    f'"format" could not be inferred from asset name: {asset_name} in {asset}, must specify explicitly'
                 )
+                return 1
 
-            artifact_entry = {
-                "size": size,
-                "hash": hash_algo,
-                "digest": hash_hex,
-                "format": asset_format,
-                "path": path,
-                "providers": providers,
-            }
-
-            # If `"format": null` was specified, there should not be a "format"
-            # field in the arifact entry.
-            if not asset_format:
-                del artifact_entry["format"]
+        hash_args[platform_name] = (
+            hostname,
+            asset["url"],
+            asset_name,
+            hash_algo,
+            size,
+        )
+
+        providers = []
+        if include_http_provider:
+            providers.append(
+                {
+                    "url": asset["browser_download_url"],
+                }
+            )
+        if include_github_release_provider:
+            providers.append(
+                {
+                    "type": "github-release",
+                    "repo": gh_repo_arg,
+                    "tag": tag,
+                    "name": asset_name,
+                }
+            )
 
-            platforms[platform_name] = artifact_entry
+        artifact_entry = {
+            "size": size,
+            "hash": hash_algo,
+            # Filled in once all of the assets have been hashed.
+            "digest": None,
+            "format": asset_format,
+            "path": path,
+            "providers": providers,
+        }
+
+        # If `"format": null` was specified, there should not be a "format"
+        # field in the arifact entry.
+        if not asset_format:
+            del artifact_entry["format"]
+
+        platforms[platform_name] = artifact_entry
+
+    # Downloading and hashing an asset is dominated by network I/O, so fetch
+    # all of them concurrently.
+    # Platforms that are served by the same asset (such as a universal macOS
+    # binary) share a single download, as the cache on compute_hash() cannot
+    # dedupe calls that are still in flight.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+        hash_futures = {
+            args: executor.submit(compute_hash, *args)
+            for args in dict.fromkeys(hash_args.values())
+        }
+    for platform_name, args in hash_args.items():
+        platforms[platform_name]["digest"] = hash_futures[args].result()
 
     manifest = {
         "name": name,
@@ -240,6 +324,10 @@ def map_platforms(
         return "ParseError"
 
     platform_entries = {}
+    # Several platforms may share a regex (e.g., when one universal binary
+    # serves more than one platform), so the assets are scanned only once for
+    # each distinct regex.
+    regex_to_asset: Dict[str, Any] = {}
     for platform, platform_config in platforms.items():
         name = platform_config.get("name")
         name_regex = platform_config.get("regex")
@@ -256,124 +344,171 @@ def map_platforms(
 
         if name:
             # Try to match the name exactly:
-            for asset_name, asset in name_to_asset.items():
-                if asset_name == name:
-                    platform_entries[platform] = (asset, platform_config)
-                    break
-            if platform in platform_entries:
-                continue
-            else:
+            asset = name_to_asset.get(name)
+            if asset is None:
                 logging.error(f"could not find asset with name '{name}'")
                 return "NoMatchForAsset"
         else:
             # Try to match the name using a regular expression.
-            regex = re.compile(name_regex)
-            for asset_name, asset in name_to_asset.items():
-                if regex.match(asset_name):
-                    platform_entries[platform] = (asset, platform_config)
-                    break
-            if platform in platform_entries:
-                continue
-            else:
+            if name_regex not in regex_to_asset:
+                try:
+                    regex = re.compile(name_regex)
+                except re.error as e:
+                    logging.error(f"invalid regex '{name_regex}' for {platform}: {e}")
+                    return "ParseError"
+                regex_to_asset[name_regex] = next(
+                    (
+                        asset
+                        for asset_name, asset in name_to_asset.items()
+                        if regex.match(asset_name)
+                    ),
+                    None,
+                )
+            asset = regex_to_asset[name_regex]
+            if asset is None:
                 logging.error(f"could not find asset matching regex '{name_regex}'")
                 return "NoMatchForAsset"
 
+        platform_entries[platform] = (asset, platform_config)
+
     return platform_entries
 
 
-@cache
+@lru_cache(maxsize=256)
 def compute_hash(
-    gh_repo_arg: str,
-    temp_dir: str,
-    tag: str,
+    hostname: str,
+    asset_url: str,
     name: str,
     hash_algo: HashAlgorithm,
     size: int,
 ) -> str:
-    """Fetches the release entry corresponding to the specified (tag, name) tuple,
-    fetches the contents, verifies the size matches, and computes the hash.
+    """Fetches the contents of the release asset at the specified API URL,
+    verifies the size matches, and computes the hash.
+
+    The contents are hashed as they are streamed from the server rather than
+    being written to disk first.
 
     Return value is a hex string representing the hash.
     """
-    output_filename = os.path.join(temp_dir, name)
-
-    # Fetch the url using the gh CLI to ensure authentication is handled correctly.
-    args = [
-        "gh",
-        "release",
-        "download",
-        tag,
-        "--repo",
-        gh_repo_arg,
-        # --pattern takes a "glob pattern", though we want to match an exact
-        # filename. Using re.escape() seems to do the right thing, though adding
-        # ^ and $ appears to break things.
-        "--pattern",
-        re.escape(name),
-        "--output",
-        output_filename,
-    ]
-    subprocess.run(args, check=True)
-    stats = os.stat(output_filename)
-    if stats.st_size != size:
-        raise Exception(f"expected size {size} for {name} but got {stats.st_size}")
-
     if hash_algo == "blake3":
         import blake3
 
-        hasher = blake3.blake3()
-        with open(output_filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
-        digest = hasher.digest()
-        return digest.hex()
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
     elif hash_algo == "sha256":
         import hashlib
 
         hasher = hashlib.sha256()
-        with open(output_filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
-        return hasher.hexdigest()
+    else:
+        raise Exception(f"unsupported hash algorithm '{hash_algo}' for {name}")
+
+    # The API URL redirects to the actual download location when the
+    # application/octet-stream media type is requested.
+    num_bytes = 0
+    with _session(hostname).get(
+        asset_url,
+        headers={"Accept": "application/octet-stream"},
+        stream=True,
+        timeout=REQUEST_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            num_bytes += len(chunk)
+
+    if num_bytes != size:
+        raise Exception(f"expected size {size} for {name} but got {num_bytes}")
+
+    return hasher.hexdigest()
 
 
 def get_config(
-    *, path_to_config: str, config_ref: str, github_repository: str, api_url: str
+    *,
+    path_to_config: str,
+    config_ref: str,
+    github_repository: str,
+    api_url: str,
+    hostname: str,
 ) -> Any:
-    args = [
-        "gh",
-        "api",
-        "-X",
-        "GET",
+    response = _session(hostname).get(
         f"{api_url}/repos/{github_repository}/contents/{path_to_config}",
-        "-H",
-        "Accept: application/vnd.github.raw",
-        "-f",
-        f"ref={config_ref}",
-    ]
-    output = subprocess.check_output(args)
-    return json.loads(output.decode("utf-8"))
-
-
-def get_release_assets(*, tag: str, github_repository) -> Dict[str, Any]:
-    args = [
-        "gh",
-        "release",
-        "view",
-        tag,
-        "--repo",
-        github_repository,
-        "--json",
-        "assets",
-    ]
-    output = subprocess.check_output(args)
-    release_data = json.loads(output.decode("utf-8"))
+        headers={"Accept": "application/vnd.github.raw"},
+        params={"ref": config_ref},
+        timeout=REQUEST_TIMEOUT,
+    )
+    response.raise_for_status()
+    return json.loads(response.content)
+
+
+def get_release_assets(
+    *, tag: str, github_repository: str, api_url: str, hostname: str
+) -> Dict[str, Any]:
+    response = _session(hostname).get(
+        f"{api_url}/repos/{github_repository}/releases/tags/{tag}",
+        timeout=REQUEST_TIMEOUT,
+    )
+    if response.status_code == 404:
+        # Draft releases are not returned by the tags endpoint, so, like
+        # `gh release view`, search the list of releases for a matching tag.
+        release_data = _find_release_in_list(
+            tag=tag,
+            github_repository=github_repository,
+            api_url=api_url,
+            hostname=hostname,
+        )
+    else:
+        response.raise_for_status()
+        release_data = json.loads(response.content)
     assets = release_data.get("assets")
     if not assets:
         raise Exception(f"no assets found for release '{tag}'")
     return {asset["name"]: asset for asset in assets if asset["state"] == "uploaded"}
 
 
+def _find_release_in_list(
+    *, tag: str, github_repository: str, api_url: str, hostname: str
+) -> Any:
+    url = f"{api_url}/repos/{github_repository}/releases"
+    params = {"per_page": 100}
+    while url:
+        response = _session(hostname).get(url, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        for release in json.loads(response.content):
+            if release.get("tag_name") == tag:
+                return release
+        # The "next" link already carries the query parameters.
+        url = response.links.get("next", {}).get("url")
+        params = None
+    raise Exception(f"no release found for tag '{tag}'")
+
+
+@cache
+def _session(hostname: str) -> requests.Session:
+    """Returns a session shared by all requests to the GitHub API on the
+    specified host so that connections are reused rather than re-established
+    for every call.
+    """
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {_get_token(hostname)}",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+    )
+    return session
+
+
+def _get_token(hostname: str) -> str:
+    # Prefer a token from the environment, falling back to the one the gh CLI
+    # is configured with. Like gh, only use the *_ENTERPRISE_TOKEN variables
+    # for hosts other than github.com.
+    token = ENV.token if hostname == "github.com" else ENV.enterprise_token
+    if token:
+        return token
+    output = subprocess.check_output(["gh", "auth", "token", "--hostname", hostname])
+    return output.decode("utf-8").strip()
+
+
 def guess_artifact_format_from_asset_name(asset_name: str) -> Optional[ArtifactFormat]:
     if asset_name.endswith(".tar.gz") or asset_name.endswith(".tgz"):
         return "tar.gz"
@@ -404,7 +539,7 @@ def parse_args():
     parser.add_argument(
         "--repo",
         help="github repo specified in `ORG/REPO` format",
-        default=os.getenv("GITHUB_REPOSITORY"),
+        default=ENV.repo,
     )
     parser.add_argument(
         "--upload",
@@ -418,31 +553,31 @@ def parse_args():
     parser.add_argument(
         "--config-ref",
         help=f"SHA of Git commit to look up the config, defaults to {default_config_ref}",
-        default=os.getenv("GITHUB_SHA", default_config_ref),
+        default=ENV.sha or default_config_ref,
     )
 
     default_server = "https://github.com"
     parser.add_argument(
         "--server",
         help=f"URL for the GitHub server, defaults to {default_server}",
-        default=os.getenv("GITHUB_SERVER_URL", default_server),
+        default=ENV.server_url or default_server,
     )
 
     default_api_server = "https://api.github.com"
     parser.add_argument(
         "--api-server",
         help=f"URL for the GitHub API server, defaults to {default_api_server}",
-        default=os.getenv("GITHUB_API_URL", default_api_server),
+        default=ENV.api_url or default_api_server,
     )
 
     parser.add_argument(
         "--output",
         help=f"folder where DotSlash files should be written, defaults to $GITHUB_WORKSPACE",
-        default=os.getenv("GITHUB_WORKSPACE"),
+        default=ENV.workspace,
     )
 
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(_main())